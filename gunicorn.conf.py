@@ -0,0 +1,11 @@
+# gunicorn.conf.py - Town of Shadows
+# Run with: gunicorn main:app -c gunicorn.conf.py
+# Rooms live in the worker's memory and gunicorn workers share one listening
+# socket (the kernel picks who accepts), so there must be exactly one worker.
+
+import os
+
+worker_class = "uvicorn_worker.UvicornWorker"
+workers = 1
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+keepalive = 5
@@ -1,11 +1,17 @@
 
 # main.py - Town of Shadows (uselesschatgpt build)
 # Note: Accepts websocket connections at /ws, /ws/, /ws/{room_id}, /ws/{room_id}/
-# Run with: uvicorn main:app --host 0.0.0.0 --port $PORT
+# Run with: uvicorn main:app --host 0.0.0.0 --port $PORT --loop uvloop --http httptools
 
-import asyncio, json, random, time
-from typing import Dict, Any
-from uuid import uuid4
+import asyncio, itertools, os, random, secrets, time, traceback
+from collections import Counter
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Dict, Any, Optional
+
+import jsonpatch
+import msgpack
+import orjson
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
@@ -18,30 +24,78 @@ DAY_VOTE = 20
 DAY_DEFENCE = 10
 DAY_FINAL = 10
 TOTAL_PLAYERS = 20
-
-TOWN_POOL = ["Doctor","Detective","Bodyguard","Vigilante","Jailor","Soldier","Cupid","Gossip","Lookout","Mayor","Investigator","Escort","Medium"]
-MAFIA_POOL = ["Godfather","Mafioso","Janitor","Spy","Beastman","Blackmailer","Framer"]
-CULT_POOL = ["Cult Leader","Fanatic","Infiltrator","Prophet","Acolyte"]
-NEUTRAL_POOL = ["Jester","Executioner","Serial Killer","Arsonist","Survivor","Amnesiac","Witch","Guardian Angel"]
+# dev escape hatch: CORS_ANY_ORIGIN=1 allows every origin (without credentials)
+CORS_ANY_ORIGIN = os.environ.get("CORS_ANY_ORIGIN") == "1"
+OUTBOX_SIZE = 256
+MAX_BATCH = 32
+ENDED_ROOM_TTL = 300
+
+TOWN_POOL = ("Doctor","Detective","Bodyguard","Vigilante","Jailor","Soldier","Cupid","Gossip","Lookout","Mayor","Investigator","Escort","Medium")
+MAFIA_POOL = ("Godfather","Mafioso","Janitor","Spy","Beastman","Blackmailer","Framer")
+CULT_POOL = ("Cult Leader","Fanatic","Infiltrator","Prophet","Acolyte")
+NEUTRAL_POOL = ("Jester","Executioner","Serial Killer","Arsonist","Survivor","Amnesiac","Witch","Guardian Angel")
+
+# filled in reverse so an overlapping role keeps the earliest pool's faction
+ROLE_FACTION: Dict[str, str] = {}
+for _faction, _pool in (("Neutral",NEUTRAL_POOL),("Cult",CULT_POOL),("Mafia",MAFIA_POOL),("Town",TOWN_POOL)):
+    ROLE_FACTION.update(dict.fromkeys(_pool, _faction))
 
 def role_to_faction(r: str) -> str:
-    if r in TOWN_POOL: return "Town"
-    if r in MAFIA_POOL: return "Mafia"
-    if r in CULT_POOL: return "Cult"
-    if r in NEUTRAL_POOL: return "Neutral"
-    return "Unknown"
+    return ROLE_FACTION.get(r, "Unknown")
 
 app = FastAPI()
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=FRONTEND_ORIGINS + ["*"],
-    allow_credentials=True,
+    allow_origins=["*"] if CORS_ANY_ORIGIN else FRONTEND_ORIGINS,
+    allow_credentials=not CORS_ANY_ORIGIN,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
+def encode(message) -> str:
+    # orjson emits bytes; clients read text frames so decode once here
+    return orjson.dumps(message).decode()
+
+# Clients that offer the "msgpack" subprotocol get MessagePack binary frames.
+MSGPACK = "msgpack"
+
+# One outgoing message. It is JSON-encoded once up front and packed to
+# MessagePack from the message itself the first time a msgpack socket is
+# sent it, so rooms without such sockets never pack and the rest pack once.
+class Frame:
+    __slots__ = ("message", "text", "_packed")
+
+    def __init__(self, message):
+        self.message = message
+        self.text = encode(message)
+        self._packed = None
+
+    def payload(self, binary):
+        if not binary: return self.text
+        if self._packed is None:
+            self._packed = msgpack.packb(self.message, use_bin_type=True)
+        return self._packed
+
+def wants_msgpack(ws) -> bool:
+    return MSGPACK in ws.scope.get("subprotocols", ())
+
+def msgpack_array_header(n) -> bytes:
+    return bytes((0x90 | n,)) if n < 16 else b"\xdc" + n.to_bytes(2, "big")
+
+# fixed system replies, encoded once at import
+INVALID_JSON_FRAME = Frame({"type":"system","text":"Invalid JSON"})
+ROOM_NOT_FOUND_FRAME = Frame({"type":"system","text":"Room not found"})
+NEED_CONNECT_TO_FRAME = Frame({"type":"system","text":"Send connect_to to join a room"})
+
 rooms: Dict[str, Dict[str, Any]] = {}
-ws_managers: Dict[str, Dict[str, WebSocket]] = {}
+ws_managers: Dict[str, Dict[int, Dict[str, Any]]] = {}
+# room id -> number of ?patch=1 sockets, so rooms without any skip the diff
+patch_sockets: Counter = Counter()
+# connection ids only need to be unique within this process
+conn_ids = itertools.count(1)
+# room ids are the only thing gating /join-room and identify, so they come
+# from secrets and are redrawn on collision with a live room
+ROOM_ID_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ234567"
 
 class CreateRoomReq(BaseModel):
     host_name: str = "Host"
@@ -50,44 +104,98 @@ class JoinReq(BaseModel):
     roomId: str
     name: str = "Player"
 
+class Phase(IntEnum):
+    WAITING=0
+    NIGHT=1
+    DAY_DISCUSS=2
+    DAY_VOTE=3
+    DAY_DEFENCE=4
+    DAY_FINAL=5
+
+    @property
+    def wire(self) -> str:
+        # clients still see the lowercase names ("night", "day_vote", ...)
+        return self.name.lower()
+
+# players are compared by identity (eq=False) like the dicts they replaced
+@dataclass(slots=True, eq=False)
+class Player:
+    slot: int
+    name: str
+    role: str
+    faction: str
+    is_bot: bool = True
+    alive: bool = True
+    ws_id: Optional[int] = None
+    revealed: bool = False
+    soldier_used: bool = False
+    contacted: bool = False
+    culted: bool = False
+
+BOT_CHAT_TEMPLATES = (
+    "I feel like {name} is acting strange.",
+    "{name} was pretty quiet.",
+    "Why is {name} so defensive?",
+    "Maybe we should skip this time.",
+    "I don't trust {name}.",
+    "{name} seems suspicious.",
+)
+
+MAFIA_FILLERS = tuple(r for r in MAFIA_POOL if r not in ("Godfather","Mafioso")) + ("Mafioso",)
+
 def sample_roles():
-    roles=[]
-    while len(roles)<8:
-        roles.append(random.choice(TOWN_POOL))
-    mafia=["Godfather","Mafioso"]
-    remaining=[r for r in MAFIA_POOL if r not in mafia]
-    while len(mafia)<4:
-        mafia.append(random.choice(remaining+["Mafioso"]))
-    roles.extend(mafia)
-    roles.extend(["Cult Leader","Fanatic","Acolyte"])
-    roles.extend(random.sample(NEUTRAL_POOL,3))
-    while len(roles)<TOTAL_PLAYERS:
-        roles.append(random.choice(TOWN_POOL))
+    roles=random.choices(TOWN_POOL, k=8)
+    roles+=["Godfather","Mafioso"]+random.choices(MAFIA_FILLERS, k=2)
+    roles+=["Cult Leader","Fanatic","Acolyte"]
+    roles+=random.sample(NEUTRAL_POOL,3)
+    roles+=random.choices(TOWN_POOL, k=TOTAL_PLAYERS-len(roles))
     random.shuffle(roles)
     return roles
 
+def next_room_id():
+    while True:
+        rid="".join(secrets.choice(ROOM_ID_ALPHABET) for _ in range(6))
+        if rid not in rooms: return rid
+
 def create_room(host_name="Host"):
-    rid=str(uuid4())[:6].upper()
+    rid=next_room_id()
     roles=sample_roles()
     players=[]
     for i in range(1,TOTAL_PLAYERS+1):
         r=roles[i-1]
-        players.append({
-            "slot":i,"name":f"Player {i}","is_bot":True,"alive":True,"role":r,"faction":role_to_faction(r),
-            "ws_id":None,"revealed":False,"soldier_used":False,"contacted":False,"culted":False
-        })
-    room={"id":rid,"host":host_name,"players":players,"state":"waiting","phase":"waiting","day":0,
-          "actions":[],"votes":{},"accused":None,"verdict_votes":{},"controller_task":None,"mafia_night_actions":{}}
+        players.append(Player(slot=i, name=f"Player {i}", role=r, faction=role_to_faction(r)))
+    faction_members={}
+    alive_by_faction={}
+    for p in players:
+        faction_members.setdefault(p.faction,[]).append(p)
+        alive_by_faction.setdefault(p.faction,{})[p.slot]=p
+    room={"id":rid,"host":host_name,"players":players,"state":"waiting","phase":Phase.WAITING,"deadline":None,"day":0,
+          "actions":[],"votes":{},"vote_tally":Counter(),"accused":None,"verdict_votes":{},"controller_task":None,"mafia_night_actions":{},
+          "by_slot":{p.slot:p for p in players},"by_name":{p.name:p for p in players},
+          "faction_members":faction_members,
+          "alive":{p.slot:p for p in players},"alive_by_faction":alive_by_faction,"dead":{},"_summary_cache":None,"_sent_summary":None,"_mates_cache":{}}
     rooms[rid]=room
     ws_managers[rid]={}
     return room
 
 def room_summary(room):
-    return {"id":room["id"],"host":room["host"],"state":room["state"],"phase":room["phase"],
-            "day":room["day"],"players":[{"slot":p["slot"],"name":p["name"],"alive":p["alive"],
-            "revealed":p["revealed"],"is_bot":p["is_bot"],"role":p["role"] if p["revealed"] else None,"faction":p["faction"]} for p in room["players"]],
+    return {"id":room["id"],"host":room["host"],"state":room["state"],"phase":room["phase"].wire,
+            "deadline":room["deadline"],"day":room["day"],"players":[{"slot":p.slot,"name":p.name,"alive":p.alive,
+            "revealed":p.revealed,"is_bot":p.is_bot,"role":p.role if p.revealed else None,"faction":p.faction} for p in room["players"]],
             "accused":room.get("accused")}
 
+# The summary and its encoded {"type":"room"} message are cached on the room
+# as a (summary, payload) pair; every write to a field that room_summary
+# exposes must call mark_dirty(room).
+def mark_dirty(room):
+    room["_summary_cache"]=None
+
+def summary_payload(room):
+    if room["_summary_cache"] is None:
+        summary=room_summary(room)
+        room["_summary_cache"]=(summary, Frame({"type":"room","room":summary}))
+    return room["_summary_cache"][1]
+
 @app.get("/test")
 async def test(): return {"message":"Hello from Town of Shadows backend"}
 
@@ -102,139 +210,301 @@ async def join_room_endpoint(req: JoinReq):
     if rid not in rooms:
         raise HTTPException(status_code=404, detail="Room not found")
     room=rooms[rid]
-    slot=next((p for p in room["players"] if p["is_bot"]), None)
+    slot=next((p for p in room["players"] if p.is_bot), None)
     if not slot:
         raise HTTPException(status_code=400, detail="Room full")
-    slot["is_bot"]=False
-    slot["name"]=req.name or slot["name"]
-    return {"slot":slot["slot"], "role":slot["role"], "faction":slot["faction"], "room": room_summary(room)}
+    slot.is_bot=False
+    if req.name and req.name!=slot.name:
+        if room["by_name"].get(slot.name) is slot: del room["by_name"][slot.name]
+        slot.name=req.name
+        room["by_name"].setdefault(slot.name, slot)
+        mark_mates_dirty(room)
+    mark_dirty(room)
+    return {"slot":slot.slot, "role":slot.role, "faction":slot.faction, "room": room_summary(room)}
 
 # WebSocket helpers
-async def send_to_ws(room_id, wsid, message):
-    mgr = ws_managers.get(room_id, {})
-    ws = mgr.get(wsid)
-    if not ws: return
+# Each connection gets an outbox queue drained by its own writer task, so a
+# slow client only backs up its own queue instead of stalling the room.
+async def ws_writer(room_id, wsid, ws, q, batch, binary):
+    try:
+        while True:
+            payload = await q.get()
+            if batch:
+                # clients that connected with ?batch=1 get everything that
+                # piled up since the last send as one array frame; the
+                # queued payloads are already encoded, so only join them
+                msgs = [payload]
+                while len(msgs) < MAX_BATCH and not q.empty():
+                    msgs.append(q.get_nowait())
+                if binary: payload = msgpack_array_header(len(msgs)) + b"".join(msgs)
+                else: payload = "[" + ",".join(msgs) + "]"
+            if binary: await ws.send_bytes(payload)
+            else: await ws.send_text(payload)
+    except asyncio.CancelledError:
+        raise
+    except:
+        drop_ws(room_id, wsid)
+
+def add_ws(room_id, wsid, ws):
+    # outboxes hold payloads already in the socket's own format
+    q = asyncio.Queue(maxsize=OUTBOX_SIZE)
+    batch = ws.query_params.get("batch") == "1"
+    patch = ws.query_params.get("patch") == "1"
+    binary = wants_msgpack(ws)
+    room = rooms.get(room_id)
+    if patch and room and room["_sent_summary"]:
+        # ?patch=1 clients start from the last summary the room was sent
+        q.put_nowait(room["_sent_summary"][1].payload(binary))
+    writer = asyncio.create_task(ws_writer(room_id, wsid, ws, q, batch, binary))
+    ws_managers.setdefault(room_id,{})[wsid] = {"ws":ws, "q":q, "writer":writer, "patch":patch, "binary":binary}
+    if patch: patch_sockets[room_id]+=1
+
+def drop_ws(room_id, wsid):
+    entry = ws_managers.get(room_id, {}).pop(wsid, None)
+    if not entry: return
+    if entry["patch"]:
+        patch_sockets[room_id]-=1
+        if not patch_sockets[room_id]: del patch_sockets[room_id]
+    if entry["writer"] is not asyncio.current_task():
+        entry["writer"].cancel()
+
+async def accept_ws(ws):
+    await ws.accept(subprotocol=MSGPACK if wants_msgpack(ws) else None)
+
+# for replies before the socket has an outbox (not yet in a room)
+async def send_direct(ws, frame):
+    if wants_msgpack(ws): await ws.send_bytes(frame.payload(True))
+    else: await ws.send_text(frame.text)
+
+async def close_ws(ws, code):
     try:
-        await ws.send_text(json.dumps(message))
+        await ws.close(code=code)
     except:
-        mgr.pop(wsid, None)
+        pass
 
-async def broadcast(room_id, message):
+# close tasks stay referenced until they finish so none is collected mid-close
+closing = set()
+
+def kick_ws(room_id, wsid, code=1013):
+    entry = ws_managers.get(room_id, {}).get(wsid)
+    if not entry: return
+    drop_ws(room_id, wsid)
+    task = asyncio.create_task(close_ws(entry["ws"], code))
+    closing.add(task)
+    task.add_done_callback(closing.discard)
+
+def enqueue(room_id, wsid, entry, frame):
+    try:
+        entry["q"].put_nowait(frame.payload(entry["binary"]))
+    except asyncio.QueueFull:
+        # client is not keeping up; disconnect it rather than buffer forever
+        kick_ws(room_id, wsid)
+
+def send_raw(room_id, wsid, frame):
+    entry = ws_managers.get(room_id, {}).get(wsid)
+    if not entry: return
+    enqueue(room_id, wsid, entry, frame)
+
+async def send_to_ws(room_id, wsid, message):
+    send_raw(room_id, wsid, Frame(message))
+
+# patch is what ?patch=1 sockets get instead of frame: False means the same
+# frame as everyone else, None means nothing
+def broadcast_raw(room_id, frame, patch=False):
     mgr = ws_managers.get(room_id, {})
-    dead=[]
-    for wsid, ws in list(mgr.items()):
+    full=[]
+    for wsid, entry in mgr.items():
+        f = patch if patch is not False and entry["patch"] else frame
+        if f is None: continue
         try:
-            await ws.send_text(json.dumps(message))
-        except:
-            dead.append(wsid)
-    for d in dead: mgr.pop(d, None)
+            entry["q"].put_nowait(f.payload(entry["binary"]))
+        except asyncio.QueueFull:
+            full.append(wsid)
+    for wsid in full: kick_ws(room_id, wsid)
+
+def faction_raw(room_id, faction, frame):
+    room=rooms.get(room_id)
+    if not room: return
+    for p in room["faction_members"].get(faction,()):
+        if p.ws_id:
+            send_raw(room_id, p.ws_id, frame)
+
+# nothing to encode for a room nobody is watching
+def has_listeners(room_id):
+    return bool(ws_managers.get(room_id))
+
+async def broadcast(room_id, message):
+    if not has_listeners(room_id): return
+    broadcast_raw(room_id, Frame(message))
+
+# Full summaries go to every socket; ?patch=1 sockets get a JSON Patch
+# (RFC 6902) against the previous broadcast instead, computed once per call
+# and only while the room has such a socket.
+async def broadcast_room(room_id):
+    room=rooms.get(room_id)
+    if not room or not has_listeners(room_id): return
+    full=summary_payload(room)
+    sent=room["_sent_summary"]
+    if not patch_sockets[room_id]: patch=False
+    elif sent is None: patch=full
+    elif sent is room["_summary_cache"]: patch=None
+    else:
+        ops=jsonpatch.make_patch(sent[0], room["_summary_cache"][0]).patch
+        patch=Frame({"type":"room_patch","ops":ops}) if ops else None
+    room["_sent_summary"]=room["_summary_cache"]
+    broadcast_raw(room_id, full, patch)
 
 async def send_to_player(room_id, player_name, message):
     room=rooms.get(room_id)
     if not room: return
-    p=next((x for x in room["players"] if x["name"]==player_name), None)
+    p=room["by_name"].get(player_name)
     if not p: return
-    wsid=p.get("ws_id")
+    wsid=p.ws_id
     if not wsid: return
     await send_to_ws(room_id, wsid, message)
 
 async def send_to_faction(room_id, faction, message):
-    room=rooms.get(room_id)
-    if not room: return
-    for p in room["players"]:
-        if p["faction"]==faction and p.get("ws_id"):
-            await send_to_player(room_id, p["name"], message)
+    if room_id not in rooms or not has_listeners(room_id): return
+    faction_raw(room_id, faction, Frame(message))
+
+MATE_SEERS = frozenset(("Fanatic","Cult Leader"))
 
 def faction_list(room, viewer):
     items=[]
-    for p in room["players"]:
-        if p["faction"]!=viewer.get("faction"): continue
-        if p["role"]=="Fanatic" and not p.get("contacted",False):
-            if viewer["role"] not in ("Fanatic","Cult Leader"): continue
-        if p["role"]=="Spy" and not p.get("contacted",False): continue
-        items.append({"slot":p["slot"],"role":p["role"],"name":p["name"],"alive":p["alive"]})
+    for p in room["faction_members"].get(viewer.faction,()):
+        if p.role=="Fanatic" and not p.contacted:
+            if viewer.role not in MATE_SEERS: continue
+        if p.role=="Spy" and not p.contacted: continue
+        items.append({"slot":p.slot,"role":p.role,"name":p.name,"alive":p.alive})
     return items
 
 async def send_faction_mates(room_id):
     room=rooms.get(room_id)
     if not room: return
-    for p in room["players"]:
-        if not p.get("ws_id"): continue
-        if p.get("faction") in ("Mafia","Cult"):
-            mates = faction_list(room,p)
-            await send_to_player(room_id,p["name"],{"type":"faction_mates","mates":mates})
+    for faction in ("Mafia","Cult"):
+        for p in room["faction_members"].get(faction,()):
+            if not p.ws_id: continue
+            send_raw(room_id,p.ws_id,mates_payload(room,p))
+
+# A faction's mates list only differs by whether the viewer can see an
+# uncontacted Fanatic, so encoded lists are cached per (faction, seer) and
+# dropped by mark_mates_dirty whenever a member's name, alive or contacted
+# flag changes.
+def mates_payload(room, viewer):
+    key=(viewer.faction, viewer.role in MATE_SEERS)
+    payload=room["_mates_cache"].get(key)
+    if payload is None:
+        payload=room["_mates_cache"][key]=Frame({"type":"faction_mates","mates":faction_list(room,viewer)})
+    return payload
+
+def mark_mates_dirty(room):
+    room["_mates_cache"].clear()
+
+# room["alive"], room["alive_by_faction"] and room["dead"] (slot -> player)
+# are maintained here so helpers never rescan all players for the living
+# or the dead
+def kill_player(room, p):
+    p.alive=False
+    room["alive"].pop(p.slot, None)
+    room["alive_by_faction"][p.faction].pop(p.slot, None)
+    room["dead"][p.slot]=p
+    mark_dirty(room)
+    mark_mates_dirty(room)
+
+async def receive_message(websocket):
+    # raw receive() so binary frames go straight to the decoder without a str
+    # copy; binary frames on a msgpack socket are MessagePack, anything else is
+    # JSON. Malformed input, or anything but an object, raises ValueError.
+    ev = await websocket.receive()
+    if ev["type"]=="websocket.disconnect":
+        raise WebSocketDisconnect(ev.get("code",1000), ev.get("reason"))
+    data = ev.get("text")
+    if data is None:
+        data = ev.get("bytes") or b""
+        msg = msgpack.unpackb(data) if wants_msgpack(websocket) else orjson.loads(data)
+    else:
+        msg = orjson.loads(data)
+    if not isinstance(msg, dict): raise ValueError("message is not an object")
+    return msg
 
 # WebSocket endpoints
 # Support multiple route shapes to be robust against trailing slash or missing room in URL.
 @app.websocket("/ws/{room_id}")
 @app.websocket("/ws/{room_id}/")
 async def websocket_with_room(websocket: WebSocket, room_id: str):
-    await websocket.accept()
-    await websocket.send_text(json.dumps({"type":"system","text":"Connected to ws with room path","room":room_id}))
+    await accept_ws(websocket)
+    await send_direct(websocket, Frame({"type":"system","text":"Connected to ws with room path","room":room_id}))
     if room_id not in rooms:
-        await websocket.send_text(json.dumps({"type":"system","text":"Room not found"}))
+        await send_direct(websocket, ROOM_NOT_FOUND_FRAME)
         await websocket.close()
         return
-    wsid=str(uuid4())
-    ws_managers[room_id][wsid]=websocket
+    wsid=next(conn_ids)
+    add_ws(room_id, wsid, websocket)
     try:
         # keep receiving messages
         while True:
-            raw = await websocket.receive_text()
             try:
-                msg = json.loads(raw)
-            except:
-                await websocket.send_text(json.dumps({"type":"system","text":"Invalid JSON"}))
+                msg = await receive_message(websocket)
+            except ValueError:
+                send_raw(room_id, wsid, INVALID_JSON_FRAME)
                 continue
             await handle_ws(room_id, wsid, msg)
     except WebSocketDisconnect:
-        ws_managers[room_id].pop(wsid, None)
+        drop_ws(room_id, wsid)
     except Exception:
-        ws_managers[room_id].pop(wsid, None)
+        drop_ws(room_id, wsid)
 
 # Accept connections on /ws and /ws/ (client may connect without room in path)
 @app.websocket("/ws")
 @app.websocket("/ws/")
 async def websocket_no_room(websocket: WebSocket):
-    await websocket.accept()
-    wsid=str(uuid4())
+    await accept_ws(websocket)
+    wsid=next(conn_ids)
     # temporary holding until client sends {"type":"connect_to","room":"ROOMID"}
     try:
-        await websocket.send_text(json.dumps({"type":"system","text":"Connected to generic ws, send connect_to with room id"}))
+        await send_direct(websocket, Frame({"type":"system","text":"Connected to generic ws, send connect_to with room id"}))
         while True:
-            raw = await websocket.receive_text()
             try:
-                msg = json.loads(raw)
-            except:
-                await websocket.send_text(json.dumps({"type":"system","text":"Invalid JSON"}))
+                msg = await receive_message(websocket)
+            except ValueError:
+                await send_direct(websocket, INVALID_JSON_FRAME)
                 continue
             if msg.get("type")=="connect_to" and msg.get("room"):
                 room_id = msg.get("room")
                 if room_id not in rooms:
-                    await websocket.send_text(json.dumps({"type":"system","text":"Room not found"}))
+                    await send_direct(websocket, ROOM_NOT_FOUND_FRAME)
                     await websocket.close()
                     return
                 # register this ws under the room
-                ws_managers.setdefault(room_id,{})[wsid]=websocket
-                await websocket.send_text(json.dumps({"type":"system","text":"Connected to room via generic ws","room":room_id}))
+                add_ws(room_id, wsid, websocket)
+                await send_to_ws(room_id, wsid, {"type":"system","text":"Connected to room via generic ws","room":room_id})
                 # now hand off message processing to regular handler
                 while True:
-                    raw = await websocket.receive_text()
                     try:
-                        msg = json.loads(raw)
-                    except:
-                        await websocket.send_text(json.dumps({"type":"system","text":"Invalid JSON"}))
+                        msg = await receive_message(websocket)
+                    except ValueError:
+                        send_raw(room_id, wsid, INVALID_JSON_FRAME)
                         continue
                     await handle_ws(room_id, wsid, msg)
             else:
-                await websocket.send_text(json.dumps({"type":"system","text":"Send connect_to to join a room"}))
+                await send_direct(websocket, NEED_CONNECT_TO_FRAME)
     except WebSocketDisconnect:
         # remove from any rooms it was assigned to
-        for rid, mgr in ws_managers.items():
-            if wsid in mgr: mgr.pop(wsid, None)
+        for rid in list(ws_managers): drop_ws(rid, wsid)
     except Exception:
-        for rid, mgr in ws_managers.items():
-            if wsid in mgr: mgr.pop(wsid, None)
+        for rid in list(ws_managers): drop_ws(rid, wsid)
+
+# votes maps voter -> target; vote_tally keeps the per-target counts in step.
+# Callers pass str voter/target; the new count is taken before anything is
+# released or stored so the two maps can never disagree.
+def cast_vote(room, voter, target):
+    tally=room["vote_tally"]
+    old=room["votes"].get(voter)
+    tally[target]+=1
+    if old is not None:
+        tally[old]-=1
+        if not tally[old]: del tally[old]
+    room["votes"][voter]=target
 
 async def handle_ws(room_id, wsid, msg):
     mtype = msg.get("type")
@@ -243,12 +513,13 @@ async def handle_ws(room_id, wsid, msg):
 
     if mtype=="identify":
         slot = msg.get("slot")
-        p = next((x for x in room["players"] if x["slot"]==slot), None)
+        p = room["by_slot"].get(slot) if isinstance(slot, int) else None
         if p:
-            p["ws_id"]=wsid
-            p["is_bot"]=False
-            await send_to_player(room_id,p["name"],{"type":"private_role","slot":p["slot"],"role":p["role"],"faction":p["faction"]})
-            await broadcast(room_id,{"type":"room","room":room_summary(room)})
+            p.ws_id=wsid
+            p.is_bot=False
+            mark_dirty(room)
+            await send_to_ws(room_id,p.ws_id,{"type":"private_role","slot":p.slot,"role":p.role,"faction":p.faction})
+            await broadcast_room(room_id)
         else:
             await send_to_ws(room_id, wsid, {"type":"system","text":"Slot not found"})
         return
@@ -257,12 +528,13 @@ async def handle_ws(room_id, wsid, msg):
         # support identify via connect_to in case client used generic /ws
         slot = msg.get("slot")
         if slot:
-            p = next((x for x in room["players"] if x["slot"]==slot), None)
+            p = room["by_slot"].get(slot) if isinstance(slot, int) else None
             if p:
-                p["ws_id"]=wsid
-                p["is_bot"]=False
-                await send_to_player(room_id,p["name"],{"type":"private_role","slot":p["slot"],"role":p["role"],"faction":p["faction"]})
-                await broadcast(room_id,{"type":"room","room":room_summary(room)})
+                p.ws_id=wsid
+                p.is_bot=False
+                mark_dirty(room)
+                await send_to_ws(room_id,p.ws_id,{"type":"private_role","slot":p.slot,"role":p.role,"faction":p.faction})
+                await broadcast_room(room_id)
         return
 
     # other message types (chat, player_action, vote etc.) — reuse earlier logic
@@ -270,20 +542,26 @@ async def handle_ws(room_id, wsid, msg):
         ch = msg.get("channel","public")
         text = msg.get("text","")
         sender = msg.get("from","Anon")
-        if room["phase"]=="day_vote" and text.strip().isdigit():
+        # both are echoed back out, so they must be strings orjson can encode
+        # (msgpack clients can send bin values, which decode to bytes)
+        if not isinstance(text,str) or not isinstance(sender,str):
+            await send_to_ws(room_id, wsid, {"type":"system","text":"Invalid chat message"})
+            return
+        if room["phase"]==Phase.DAY_VOTE and text.strip().isdigit():
             target_slot = int(text.strip())
-            target_p = next((x for x in room["players"] if x["slot"]==target_slot), None)
+            target_p = room["by_slot"].get(target_slot)
             if target_p:
-                room.setdefault("votes",{})[sender]=target_p["name"]
+                cast_vote(room, sender, target_p.name)
                 await send_to_ws(room_id, wsid, {"type":"system","text":f"You voted for Player {target_slot}"})
                 await broadcast(room_id, {"type":"system","text":f"{sender} cast a vote (anonymous)."})
                 return
         if ch=="mafia": await send_to_faction(room_id,"Mafia",{"type":"chat","from":sender,"text":text,"channel":"mafia"}); return
         if ch=="cult": await send_to_faction(room_id,"Cult",{"type":"chat","from":sender,"text":text,"channel":"cult"}); return
         if ch=="dead":
-            for p in room["players"]:
-                if not p["alive"] and p.get("ws_id"):
-                    await send_to_player(room_id,p["name"],{"type":"chat","from":sender,"text":text,"channel":"dead"})
+            payload=Frame({"type":"chat","from":sender,"text":text,"channel":"dead"})
+            for p in room["dead"].values():
+                if p.ws_id:
+                    send_raw(room_id,p.ws_id,payload)
             return
         await broadcast(room_id,{"type":"chat","from":sender,"text":text,"channel":"public"})
         return
@@ -291,17 +569,16 @@ async def handle_ws(room_id, wsid, msg):
     if mtype=="player_action":
         action = msg.get("action")
         if action:
-            if not room["phase"].startswith("night"):
+            if room["phase"]!=Phase.NIGHT:
                 await send_to_ws(room_id, wsid, {"type":"system","text":"Actions only allowed at night"})
                 return
             if action.get("type")=="mafia_kill":
-                room.setdefault("mafia_night_actions",{})
                 actor_name = action.get("actor")
                 role = action.get("actor_role")
                 room["mafia_night_actions"][actor_name] = {"target": action.get("target"), "role": role}
                 await send_to_ws(room_id, wsid, {"type":"system","text":"Mafia choice registered."})
                 return
-            room.setdefault("actions",[]).append({
+            room["actions"].append({
                 "actor": action.get("actor"),
                 "target": action.get("target"),
                 "type": action.get("type"),
@@ -319,23 +596,26 @@ async def handle_ws(room_id, wsid, msg):
         return
 
     if mtype=="vote":
-        if room["phase"]!="day_vote":
+        if room["phase"]!=Phase.DAY_VOTE:
             await send_to_ws(room_id, wsid, {"type":"system","text":"Voting only during vote phase"})
             return
         voter = msg.get("from")
         target = msg.get("target")
-        if isinstance(target,str) and target.isdigit():
-            tgt = next((x for x in room["players"] if x["slot"]==int(target)), None)
+        if not isinstance(voter,str) or not isinstance(target,str):
+            await send_to_ws(room_id, wsid, {"type":"system","text":"Invalid vote"})
+            return
+        if target.isdigit():
+            tgt = room["by_slot"].get(int(target))
             if tgt:
-                room.setdefault("votes",{})[voter]=tgt["name"]
-                await send_to_ws(room_id, wsid, {"type":"system","text":f"You voted for Player {tgt['slot']}"})
+                cast_vote(room, voter, tgt.name)
+                await send_to_ws(room_id, wsid, {"type":"system","text":f"You voted for Player {tgt.slot}"})
                 await broadcast(room_id, {"type":"system","text":f"{voter} cast a vote (anonymous)."})
                 return
         if target in ("skip","SKIP"):
-            room.setdefault("votes",{})[voter]="SKIP"
+            cast_vote(room, voter, "SKIP")
             await broadcast(room_id, {"type":"system","text":f"{voter} skipped voting."})
             return
-        room.setdefault("votes",{})[voter]=target
+        cast_vote(room, voter, target)
         await broadcast(room_id, {"type":"system","text":f"{voter} voted for {target}"})
         return
 
@@ -349,14 +629,13 @@ async def start_game(room_id):
         return {"ok":True}
     room["state"]="active"
     room["day"]=0
-    room["phase"]="night"
+    room["phase"]=Phase.NIGHT
     room["mafia_night_actions"] = {}
+    mark_dirty(room)
     for p in room["players"]:
-        if p.get("ws_id"):
-            await send_to_player(room_id,p["name"],{"type":"private_role","slot":p["slot"],"role":p["role"],"faction":p["faction"]})
+        if p.ws_id:
+            await send_to_ws(room_id,p.ws_id,{"type":"private_role","slot":p.slot,"role":p.role,"faction":p.faction})
     await broadcast(room_id, {"type":"game_started","text":"Game has started. Night 1 begins."})
-    await asyncio.sleep(0.6)
-    await broadcast(room_id, {"type":"game_started","text":"Game has started. Night 1 begins. (confirm)"})
     await asyncio.sleep(1.5)
     await send_faction_mates(room_id)
     await broadcast(room_id, {"type":"system","text":"Game started. Night 1 begins."})
@@ -364,52 +643,67 @@ async def start_game(room_id):
         room["controller_task"]=asyncio.create_task(phase_controller(room_id))
     return {"ok":True}
 
-async def broadcast_phase(room_id, phase_name, seconds):
+async def broadcast_phase(room_id, phase, seconds):
     room = rooms.get(room_id)
-    payload={"type":"phase","phase":phase_name,"seconds":seconds}
-    if phase_name=="day_vote":
-        payload["players"]=[{"slot":p["slot"],"name":p["name"],"alive":p["alive"]} for p in room["players"]]
+    if not has_listeners(room_id): return
+    payload={"type":"phase","phase":phase.wire,"seconds":seconds,"deadline":room["deadline"]}
+    if phase==Phase.DAY_VOTE:
+        payload["players"]=[{"slot":p.slot,"name":p.name,"alive":p.alive} for p in room["players"]]
     await broadcast(room_id, payload)
-    await broadcast(room_id, {"type":"room","room":room_summary(room)})
+    await broadcast_room(room_id)
+
+# clients count down to the deadline (epoch ms) themselves; the server only
+# sleeps once per phase and never sends ticks
+async def enter_phase(room, phase, seconds):
+    room["phase"]=phase
+    room["deadline"]=int((time.time()+seconds)*1000)
+    mark_dirty(room)
+    await broadcast_phase(room["id"], phase, seconds)
+
+# a failing bot is logged and dropped; it must not cancel its phase's sleep
+async def guard_bot(bot):
+    try:
+        await bot
+    except Exception:
+        traceback.print_exc()
+
+# wait out a phase while its bot coroutines run; whatever is still pending
+# when the phase ends is cancelled, so no bot task outlives its phase
+async def run_phase(seconds, *bots):
+    async with asyncio.TaskGroup() as tg:
+        tasks=[tg.create_task(guard_bot(b)) for b in bots]
+        await asyncio.sleep(seconds)
+        for t in tasks: t.cancel()
 
 async def phase_controller(room_id):
     room = rooms.get(room_id)
     if not room: return
     while room["state"]=="active":
         try:
-            room["phase"]="night"
             await send_faction_mates(room_id)
-            await broadcast_phase(room_id,"night",NIGHT_SECONDS)
-            asyncio.create_task(simulate_bot_night_actions(room_id))
-            await asyncio.sleep(NIGHT_SECONDS)
+            await enter_phase(room,Phase.NIGHT,NIGHT_SECONDS)
+            await run_phase(NIGHT_SECONDS, simulate_bot_night_actions(room_id))
             await apply_player_actions(room_id)
-            await check_victory(room_id)
             if room["state"]!="active": break
 
             room["day"]+=1
-            room["phase"]="day_discuss"
-            await broadcast_phase(room_id,"day_discuss",DAY_DISCUSS)
-            asyncio.create_task(simulate_bot_day_chat(room_id))
-            await asyncio.sleep(DAY_DISCUSS)
+            await enter_phase(room,Phase.DAY_DISCUSS,DAY_DISCUSS)
+            await run_phase(DAY_DISCUSS, simulate_bot_day_chat(room_id))
 
-            room["phase"]="day_vote"
             room["votes"]={}
-            await broadcast_phase(room_id,"day_vote",DAY_VOTE)
-            asyncio.create_task(simulate_bot_day_votes_and_accusations(room_id))
-            await asyncio.sleep(DAY_VOTE)
+            room["vote_tally"]=Counter()
+            await enter_phase(room,Phase.DAY_VOTE,DAY_VOTE)
+            await run_phase(DAY_VOTE, simulate_bot_day_votes_and_accusations(room_id))
 
             await determine_accused(room_id)
 
-            room["phase"]="day_defence"
-            await broadcast_phase(room_id,"day_defence",DAY_DEFENCE)
+            await enter_phase(room,Phase.DAY_DEFENCE,DAY_DEFENCE)
             await asyncio.sleep(DAY_DEFENCE)
 
             if room.get("accused"):
-                room["phase"]="day_final"
                 room["verdict_votes"]={}
                 await broadcast(room_id, {"type":"verdict_phase","accused":room["accused"],"seconds":DAY_FINAL})
-                await broadcast_phase(room_id,"day_final",DAY_FINAL)
-                asyncio.create_task(simulate_bot_verdict_votes(room_id))
+                await enter_phase(room,Phase.DAY_FINAL,DAY_FINAL)
                 await asyncio.sleep(DAY_FINAL)
                 await resolve_verdict(room_id)
             else:
@@ -419,95 +713,99 @@ async def phase_controller(room_id):
             await broadcast(room_id, {"type":"system","text":f"Phase controller error: {str(e)}"})
             await asyncio.sleep(2)
 
+# Room state is only touched from the event loop, so writes between awaits
+# never interleave; what can go wrong is a bot task that outlives its phase.
+# Bots check in_phase after every await before writing.
+def in_phase(room, phase, day):
+    return room["state"]=="active" and room["phase"]==phase and room["day"]==day
+
 # simplified bots and action resolution for stability (keeps prior behavior)
 async def simulate_bot_day_chat(room_id):
     room = rooms.get(room_id)
     if not room: return
-    alive = [p for p in room["players"] if p["alive"]]
-    bots = [p for p in alive if p["is_bot"]]
+    alive = list(room["alive"].values())
+    bots = [p for p in alive if p.is_bot]
     if not bots: return
     count = min(len(bots), random.randint(2,4))
     speakers = random.sample(bots, count)
+    schedule = []
     for i, bot in enumerate(speakers):
         delay = random.randint(6,15) + i*2
         if delay >= DAY_DISCUSS - 2:
             delay = max(1, DAY_DISCUSS - 3 - i)
-        asyncio.create_task(bot_say_after(room_id, bot["name"], delay))
-    return
-
-async def bot_say_after(room_id, bot_name, delay):
-    await asyncio.sleep(delay)
+        schedule.append((delay, bot.name))
+    # one coroutine walks the whole schedule instead of a task per speaker
+    schedule.sort(key=lambda e: e[0])
+    elapsed = 0
+    for delay, bot_name in schedule:
+        await asyncio.sleep(delay - elapsed)
+        elapsed = delay
+        await bot_say(room_id, bot_name)
+
+# bots only build their chatter and announcements when someone can see it;
+# votes and night actions are still recorded either way
+async def bot_say(room_id, bot_name):
     room = rooms.get(room_id)
-    if not room or room["state"]!="active": return
-    bot = next((p for p in room["players"] if p["name"]==bot_name), None)
-    if not bot or not bot["alive"]: return
-    alive = [p for p in room["players"] if p["alive"] and p["name"]!=bot_name]
+    if not room or room["state"]!="active" or not has_listeners(room_id): return
+    bot = room["by_name"].get(bot_name)
+    if not bot or not bot.alive: return
+    alive = [p for p in room["alive"].values() if p.name!=bot_name]
     if not alive: return
     target = random.choice(alive)
-    templates = [
-        f"I feel like {target['name']} is acting strange.",
-        f"{target['name']} was pretty quiet.",
-        f"Why is {target['name']} so defensive?",
-        f"Maybe we should skip this time.",
-        f"I don't trust {target['name']}.",
-        f"{target['name']} seems suspicious."
-    ]
-    text = random.choice(templates)
+    text = random.choice(BOT_CHAT_TEMPLATES).format(name=target.name)
     await broadcast(room_id, {"type":"chat","from":bot_name,"text":text,"channel":"public"})
 
 async def simulate_bot_day_votes_and_accusations(room_id):
     room = rooms.get(room_id)
-    if not room or room["phase"]!="day_vote": return
+    if not room or room["phase"]!=Phase.DAY_VOTE: return
+    day = room["day"]
     await asyncio.sleep(max(1, DAY_VOTE//3))
-    alive = [p for p in room["players"] if p["alive"]]
-    bots = [p for p in alive if p["is_bot"]]
+    if not in_phase(room, Phase.DAY_VOTE, day): return
+    alive = list(room["alive"].values())
+    if len(alive) < 2: return
+    bots = [p for p in alive if p.is_bot]
+    # suspicion weights are shared by every bot; a bot that draws itself
+    # redraws, which is the same as weighting the other candidates
+    cum_weights = list(itertools.accumulate(2.5 if c.faction in ("Mafia", "Cult") else 1.0 for c in alive))
     for bot in bots:
         if random.random() < 0.55:
-            candidates = [c for c in alive if c["name"]!=bot["name"]]
-            if not candidates: continue
-            weights = []
-            for c in candidates:
-                w = 1.0
-                if c["faction"] in ("Mafia", "Cult"):
-                    w = 2.5
-                weights.append((c, w))
-            total = sum(w for _,w in weights)
-            r = random.random() * total
-            upto = 0
-            pick = weights[-1][0]
-            for c, w in weights:
-                upto += w
-                if r <= upto:
-                    pick = c
-                    break
-            room.setdefault("votes", {})[bot["name"]] = pick["name"]
-            await broadcast(room_id, {"type":"system","text":f"🤖 {bot['name']} voted for {pick['name']}"})
+            pick = bot
+            while pick is bot:
+                pick = random.choices(alive, cum_weights=cum_weights)[0]
+            if not in_phase(room, Phase.DAY_VOTE, day): return
+            cast_vote(room, bot.name, pick.name)
+            if has_listeners(room_id): await broadcast(room_id, {"type":"system","text":f"🤖 {bot.name} voted for {pick.name}"})
 
 async def simulate_bot_night_actions(room_id):
     room = rooms.get(room_id)
     if not room or room["state"]!="active": return
+    day = room["day"]
     await asyncio.sleep(2)
-    alive = [p for p in room["players"] if p["alive"]]
-    mafia = [p for p in alive if p["faction"]=="Mafia"]
+    if not in_phase(room, Phase.NIGHT, day): return
+    alive = list(room["alive"].values())
+    alive_by_faction = room["alive_by_faction"]
+    mafia = list(alive_by_faction.get("Mafia",{}).values())
     if mafia:
-        candidates = [p for p in alive if p["faction"]!="Mafia"]
+        candidates = [p for p in alive if p.faction!="Mafia"]
         if candidates:
             attacker = random.choice(mafia)
             target = random.choice(candidates)
-            room.setdefault("mafia_night_actions", {})[attacker["name"]] = {"target": target["name"], "role": attacker["role"]}
-            await send_to_faction(room_id, "Mafia", {"type":"system","text":"Mafia selected a target (private)."})
-    cults = [p for p in alive if p["faction"]=="Cult"]
+            room["mafia_night_actions"][attacker.name] = {"target": target.name, "role": attacker.role}
+            if has_listeners(room_id): await send_to_faction(room_id, "Mafia", {"type":"system","text":"Mafia selected a target (private)."})
+    if not in_phase(room, Phase.NIGHT, day): return
+    cults = list(alive_by_faction.get("Cult",{}).values())
     if cults and random.random() < 0.45:
-        candidates = [p for p in alive if p["faction"] not in ("Cult","Mafia")]
+        candidates = [p for p in alive if p.faction not in ("Cult","Mafia")]
         if candidates:
             t = random.choice(candidates)
-            room.setdefault("actions", []).append({"actor":random.choice(cults)["name"],"target":t["name"],"type":"cult_convert"})
-            await send_to_faction(room_id, "Cult", {"type":"system","text":f"Cult attempted to convert {t['name']} (private)."})
-    for d in [p for p in alive if p["role"]=="Doctor"]:
+            room["actions"].append({"actor":random.choice(cults).name,"target":t.name,"type":"cult_convert"})
+            if has_listeners(room_id): await send_to_faction(room_id, "Cult", {"type":"system","text":f"Cult attempted to convert {t.name} (private)."})
+    for d in [p for p in alive if p.role=="Doctor"]:
+        if not in_phase(room, Phase.NIGHT, day): return
         if random.random() < 0.6:
-            tgt = random.choice(alive)["name"]
-            room.setdefault("actions", []).append({"actor":d["name"],"target":tgt,"type":"doctor_heal"})
-            await send_to_player(room_id, d["name"], {"type":"system","text":f"You healed {tgt} tonight."})
+            tgt = random.choice(alive).name
+            room["actions"].append({"actor":d.name,"target":tgt,"type":"doctor_heal"})
+            if has_listeners(room_id): await send_to_player(room_id, d.name, {"type":"system","text":f"You healed {tgt} tonight."})
 
 async def apply_player_actions(room_id):
     # simplified placeholder resolution for stability
@@ -515,35 +813,36 @@ async def apply_player_actions(room_id):
     if not room: return
     room["actions"] = []
     room["mafia_night_actions"] = {}
-    await broadcast(room_id, {"type":"room","room":room_summary(room)})
+    await broadcast_room(room_id)
     await send_faction_mates(room_id)
     await check_victory(room_id)
 
 async def determine_accused(room_id):
     room = rooms.get(room_id)
     if not room: return
-    votes = room.get("votes",{}) or {}
-    if not votes:
+    tally = room["vote_tally"]
+    if not tally:
         room["accused"] = None
+        mark_dirty(room)
         await broadcast(room_id, {"type":"system","text":"No accusations were made."})
         await broadcast(room_id, {"type":"accused_update","accused":None})
         return
-    tally = {}
-    for v in votes.values():
-        tally[v] = tally.get(v,0) + 1
-    sorted_counts = sorted(tally.items(), key=lambda x: x[1], reverse=True)
+    sorted_counts = tally.most_common(2)
     if len(sorted_counts) > 1 and sorted_counts[0][1] == sorted_counts[1][1]:
         room["accused"] = None
+        mark_dirty(room)
         await broadcast(room_id, {"type":"system","text":"Tie in accusations — no accused."})
         await broadcast(room_id, {"type":"accused_update","accused":None})
         return
     top = sorted_counts[0][0]
     if top == "SKIP":
         room["accused"] = None
+        mark_dirty(room)
         await broadcast(room_id, {"type":"system","text":"Voting resulted in Skip — no accused."})
         await broadcast(room_id, {"type":"accused_update","accused":None})
         return
     room["accused"] = top
+    mark_dirty(room)
     await broadcast(room_id, {"type":"system","text":f"{top} has been accused and will defend themselves."})
     await broadcast(room_id, {"type":"accused_update","accused":top})
 
@@ -556,43 +855,44 @@ async def resolve_verdict(room_id):
     if not votes:
         await broadcast(room_id, {"type":"system","text":"No verdict votes — no lynch."})
         room["accused"] = None
+        mark_dirty(room)
         await broadcast(room_id, {"type":"accused_update","accused":None})
         return
-    tally = {"guilty":0,"innocent":0}
-    for v in votes.values():
-        tally[v] = tally.get(v,0) + 1
+    tally = Counter(votes.values())
     if tally["guilty"] > tally["innocent"]:
-        victim = next((p for p in room["players"] if p["name"]==accused and p["alive"]), None)
-        if victim:
-            victim["alive"] = False
-            victim["revealed"] = True
-            await broadcast(room_id, {"type":"system","text":f"{accused} was found GUILTY — {victim['role']} ({victim['faction']})"})
+        victim = room["by_name"].get(accused)
+        if victim and victim.alive:
+            kill_player(room, victim)
+            victim.revealed = True
+            await broadcast(room_id, {"type":"system","text":f"{accused} was found GUILTY — {victim.role} ({victim.faction})"})
             room["accused"] = None
             room["verdict_votes"] = {}
-            await broadcast(room_id, {"type":"room","room":room_summary(room)})
+            mark_dirty(room)
+            await broadcast_room(room_id)
             await check_victory(room_id)
             return
     else:
         await broadcast(room_id, {"type":"system","text":f"{accused} was found INNOCENT."})
     room["accused"] = None
     room["verdict_votes"] = {}
-    await broadcast(room_id, {"type":"room","room":room_summary(room)})
+    mark_dirty(room)
+    await broadcast_room(room_id)
 
 async def check_victory(room_id):
     room = rooms.get(room_id)
     if not room: return
-    alive = [p for p in room["players"] if p["alive"]]
-    mafia = [p for p in alive if p["faction"]=="Mafia"]
-    cult = [p for p in alive if p["faction"]=="Cult"]
-    town = [p for p in alive if p["faction"]=="Town"]
-    neutral = [p for p in alive if p["faction"]=="Neutral"]
+    counts = {f: len(members) for f, members in room["alive_by_faction"].items()}
+    mafia = counts.get("Mafia",0)
+    town = counts.get("Town",0)
+    cult = counts.get("Cult",0)
+    neutral = counts.get("Neutral",0)
     if not mafia and town:
         await end_game(room_id, "Town")
         return
-    if not town and len(mafia) >= len(cult):
+    if not town and mafia >= cult:
         await end_game(room_id, "Mafia")
         return
-    if len(cult) >= (len(mafia) + len(town) + len(neutral)):
+    if cult >= mafia + town + neutral:
         await end_game(room_id, "Cult")
         return
     if neutral and not mafia and not town and not cult:
@@ -603,12 +903,29 @@ async def end_game(room_id, winner):
     room = rooms.get(room_id)
     if not room: return
     room["state"] = "ended"
+    mark_dirty(room)
     await broadcast(room_id, {"type":"system","text":f"{winner} win!"})
     recap = []
     for p in room["players"]:
-        recap.append(f"{p['name']}: {p['role']} ({p['faction']}) {'Alive' if p['alive'] else 'Dead'}")
+        recap.append(f"{p.name}: {p.role} ({p.faction}) {'Alive' if p.alive else 'Dead'}")
     await broadcast(room_id, {"type":"system","text":"Final Roles:\\n" + "\\n".join(recap)})
-    await broadcast(room_id, {"type":"room","room":room_summary(room)})
+    await broadcast_room(room_id)
+    # drop per-game state now and the room itself once clients had time to
+    # read the recap, so finished games do not pile up in memory
+    room["controller_task"] = None
+    room["actions"].clear()
+    room["mafia_night_actions"].clear()
+    room["votes"].clear()
+    room["vote_tally"].clear()
+    asyncio.get_running_loop().call_later(ENDED_ROOM_TTL, discard_room, room_id)
+
+def discard_room(room_id):
+    room = rooms.get(room_id)
+    # a room restarted with start_game during the grace period is left alone
+    if not room or room["state"]!="ended": return
+    rooms.pop(room_id, None)
+    for wsid in list(ws_managers.get(room_id, {})): kick_ws(room_id, wsid, 1001)
+    ws_managers.pop(room_id, None)
 
 @app.on_event("startup")
 async def startup_event():